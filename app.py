@@ -1,29 +1,74 @@
 import os
+from hashlib import sha256
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, abort,
+    Response
+)
+from flask_caching import Cache
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from sqlalchemy import (
+    select, insert, delete, exists, union, literal, func, true, and_
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, raiseload, load_only, aliased
 from werkzeug.exceptions import Forbidden
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+from wtforms.validators import ValidationError
 
 from forms import (
     UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm
 )
-from models import (db, connect_db, User, Message,
+from models import (db, connect_db, User, Message, Follows, Like,
                     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+USERS_PER_PAGE = 50
+MESSAGES_PER_PAGE = 50
 
 app = Flask(__name__)
 
+# Runs behind one reverse proxy (see README "Deployment"); take the client
+# address from its X-Forwarded-For so rate limits are per client
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 toolbar = DebugToolbarExtension(app)
 
+# Cache rendered feeds in Redis when it's configured; no caching otherwise
+app.config['CACHE_TYPE'] = (
+    'RedisCache' if 'REDIS_URL' in os.environ else 'NullCache'
+)
+app.config['CACHE_REDIS_URL'] = os.environ.get('REDIS_URL')
+cache = Cache(app)
+
+# bcrypt makes login/signup expensive; throttle them per client address.
+# Counts are shared through Redis when it's configured.
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    default_limits=["200/hour"],
+    storage_uri=os.environ.get('REDIS_URL', 'memory://'),
+)
+
 # To turn debug redirects off:
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -44,6 +89,84 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+
+def _get_user_or_404(user_id, options=()):
+    """Get user by id from the identity map or DB; 404 if no such user.
+
+    session.get ignores `options` for a user already in the identity map
+    (e.g. g.user, whose follows are loaded id-only), so with options the
+    user is re-selected and its attributes repopulated.
+    """
+
+    if options:
+        user = db.session.scalars(
+            select(User)
+            .where(User.id == user_id)
+            .options(*options)
+            .execution_options(populate_existing=True)
+        ).one_or_none()
+    else:
+        user = db.session.get(User, user_id)
+
+    if user is None:
+        abort(404)
+
+    return user
+
+
+def _liked_message_ids(messages):
+    """Return frozenset of ids among `messages` that g.user has liked."""
+
+    message_ids = [message.id for message in messages]
+
+    if not message_ids:
+        return frozenset()
+
+    return frozenset(db.session.scalars(
+        select(Like.message_id)
+        .where(Like.user_id == g.user.id,
+               Like.message_id.in_(message_ids))
+    ))
+
+
+def _user_counts(user_id):
+    """Return the stats-bar counts for a user, in one query.
+
+    Dict with keys messages, following, followers and likes; templates
+    use these rather than taking the length of the relationship lists.
+    """
+
+    def count(column):
+        return (select(func.count())
+                .where(column == user_id)
+                .scalar_subquery())
+
+    return db.session.execute(select(
+        count(Message.user_id).label('messages'),
+        count(Follows.user_following_id).label('following'),
+        count(Follows.user_being_followed_id).label('followers'),
+        count(Like.user_id).label('likes'),
+    )).one()._asdict()
+
+
+def _feed_cache_key():
+    """Cache key for the current user's rendered homepage feed.
+
+    Keyed by browser session as well as user, since the page embeds the
+    session's CSRF token.
+    """
+
+    session_token = sha256(session.get('csrf_token', '').encode())
+    return f"feed:{g.user.id}:{session_token.hexdigest()[:16]}"
+
+
+def _skip_feed_cache():
+    """Don't cache anon pages, pages with flashes, or before a CSRF token."""
+
+    return (not g.user
+            or '_flashes' in session
+            or 'csrf_token' not in session)
+
 ##############################################################################
 # User signup/login/logout routes
 
@@ -52,28 +175,92 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = db.session.get(
+            User,
+            session[CURR_USER_KEY],
+            options=[
+                selectinload(User.following).load_only(User.id),
+                selectinload(User.followers).load_only(User.id),
+            ]
+        )
 
     else:
         g.user = None
 
 
-@app.before_request
-def add_crsf_form_to_g():
-    """Add CSRFProtectForm to g object"""
+@app.teardown_request
+def forget_csrf_token(exc):
+    """Drop flask_wtf's per-request CSRF token from g.
+
+    connect_db keeps an app context pushed for the life of the process, and
+    requests reuse it, so anything left on g carries over to the next one.
+    """
+
+    g.pop(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), None)
+
+
+def _get_csrf_form():
+    """Build the CSRFProtectForm once per request, on first use.
+
+    Memoized on the request, not on g, which outlives the request here
+    (see forget_csrf_token).
+    """
+
+    if 'warbler.csrf_form' not in request.environ:
+        request.environ['warbler.csrf_form'] = CSRFProtectForm()
+
+    return request.environ['warbler.csrf_form']
+
+
+csrf_form = LocalProxy(_get_csrf_form)
+app.jinja_env.globals['csrf_form'] = csrf_form
+
+
+def _csrf_ok():
+    """Check the submitted CSRF token, once per request.
+
+    Checks the token directly rather than building and validating a
+    CSRFProtectForm, honoring WTF_CSRF_ENABLED like FlaskForm does. The
+    result is kept on the request, not on g, which outlives the request
+    here (see forget_csrf_token).
+    """
+
+    if 'warbler.csrf_ok' not in request.environ:
+        if not app.config.get('WTF_CSRF_ENABLED', True):
+            csrf_ok = True
+        else:
+            try:
+                validate_csrf(request.form.get('csrf_token'))
+                csrf_ok = True
+            except ValidationError:
+                csrf_ok = False
+
+        request.environ['warbler.csrf_ok'] = csrf_ok
+
+    return request.environ['warbler.csrf_ok']
+
+
+# id of the guest account, cached after its first successful login
+_GUEST_ID = None
 
-    g.csrf_form = CSRFProtectForm()
 
 @app.route('/demo', methods=["POST"])
+@limiter.limit("5/minute", methods=["POST"])
 def demo():
     """Allow easy auto-login to guest account for demo purposes"""
 
-    user = User.authenticate(
-        "guest",
-        "password"
-    )
+    global _GUEST_ID
+
+    user = _GUEST_ID and db.session.get(User, _GUEST_ID)
+
+    if not user:
+        user = User.authenticate(
+            "guest",
+            "password"
+        )
 
     if user:
+        _GUEST_ID = user.id
         do_login(user)
         flash(f"Hello, {user.username}!", "success")
         return redirect("/")
@@ -84,6 +271,7 @@ def demo():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@limiter.limit("5/minute", methods=["POST"])
 def signup():
     """Handle user signup.
 
@@ -106,7 +294,7 @@ def signup():
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=form.image_url.data or DEFAULT_IMAGE_URL,
             )
             db.session.commit()
 
@@ -123,9 +311,13 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit("5/minute", methods=["POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
+    if request.method == "GET" and _can_serve_prerendered():
+        return _serve_prerendered(_LOGIN_HTML)
+
     form = LoginForm()
 
     if form.validate_on_submit():
@@ -151,7 +343,7 @@ def logout():
 
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not _csrf_ok():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
@@ -168,7 +360,9 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username
+    (case-insensitive, first 50 matches in username order). Otherwise lists
+    users 50 at a time, starting after the user id in the 'after' param.
     """
 
     if not g.user:
@@ -176,29 +370,61 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    card_columns = load_only(User.id, User.username, User.image_url,
+                             User.header_image_url, User.bio)
+    next_after = None
 
     if not search:
-        users = User.query.all()
+        after_id = request.args.get('after', 0, type=int)
+        users = db.session.scalars(
+            select(User)
+            .where(User.id > after_id)
+            .order_by(User.id)
+            .limit(USERS_PER_PAGE)
+            .options(card_columns)
+        ).all()
+
+        if len(users) == USERS_PER_PAGE:
+            next_after = users[-1].id
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = db.session.scalars(
+            select(User)
+            .where(User.username.ilike(f"%{search}%"))
+            .order_by(User.username)
+            .limit(USERS_PER_PAGE)
+            .options(card_columns)
+        ).all()
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=users,
+        next_after=next_after
+    )
 
 
 @app.get('/users/<int:user_id>')
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile with their 50 most recent messages."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = _get_user_or_404(user_id)
+    messages = db.session.scalars(
+        select(Message)
+        .where(Message.user_id == user_id)
+        .order_by(Message.id.desc())
+        .limit(MESSAGES_PER_PAGE)
+        .options(selectinload(Message.author))
+    ).all()
 
     return render_template(
         'users/show.html',
         user=user,
-        messages=user.authored_messages
+        messages=messages,
+        liked_ids=_liked_message_ids(messages),
+        counts=_user_counts(user.id)
     )
 
 
@@ -210,8 +436,16 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = _get_user_or_404(user_id, options=[
+        selectinload(User.following)
+        .load_only(User.id, User.username, User.image_url,
+                   User.header_image_url, User.bio)
+    ])
+    return render_template(
+        'users/following.html',
+        user=user,
+        counts=_user_counts(user.id)
+    )
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -222,8 +456,16 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = _get_user_or_404(user_id, options=[
+        selectinload(User.followers)
+        .load_only(User.id, User.username, User.image_url,
+                   User.header_image_url, User.bio)
+    ])
+    return render_template(
+        'users/followers.html',
+        user=user,
+        counts=_user_counts(user.id)
+    )
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -233,13 +475,19 @@ def start_following(follow_id):
     Redirect to following page for the current for the current user.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not _csrf_ok():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    _get_user_or_404(follow_id)
+    db.session.execute(
+        pg_insert(Follows)
+        .values(user_being_followed_id=follow_id,
+                user_following_id=g.user.id)
+        .on_conflict_do_nothing()
+    )
     db.session.commit()
+    cache.delete(_feed_cache_key())
 
     return redirect(request.referrer)
 
@@ -251,13 +499,17 @@ def stop_following(follow_id):
     Redirect to following page for the current for the current user.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not _csrf_ok():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    db.session.execute(
+        delete(Follows)
+        .where(Follows.user_being_followed_id == follow_id,
+               Follows.user_following_id == g.user.id)
+    )
     db.session.commit()
+    cache.delete(_feed_cache_key())
 
     return redirect(request.referrer)
 
@@ -297,18 +549,28 @@ def profile():
 
 @app.get("/users/<int:user_id>/liked-messages")
 def show_liked_messages(user_id):
-    """Show user like messages"""
+    """Show the last 50 messages this user liked, most recently liked first"""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = _get_user_or_404(user_id)
+    messages = db.session.scalars(
+        select(Message)
+        .join(Like, Like.message_id == Message.id)
+        .where(Like.user_id == user_id)
+        .order_by(Like.id.desc())
+        .limit(MESSAGES_PER_PAGE)
+        .options(selectinload(Message.author))
+    ).all()
 
     return render_template(
         'users/show.html',
         user=user,
-        messages=user.liked_messages
+        messages=messages,
+        liked_ids=_liked_message_ids(messages),
+        counts=_user_counts(user.id)
     )
 
 @app.post('/users/delete')
@@ -318,14 +580,14 @@ def delete_user():
     Redirect to signup page.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not _csrf_ok():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     do_logout()
 
-    Message.query.filter_by(user_id=g.user.id).delete()
-    db.session.delete(g.user)
+    # messages, likes and follows go with it via ON DELETE CASCADE
+    db.session.execute(delete(User).where(User.id == g.user.id))
     db.session.commit()
 
     return redirect("/signup")
@@ -348,9 +610,11 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.authored_messages.append(msg)
+        db.session.execute(
+            insert(Message).values(text=form.text.data, user_id=g.user.id)
+        )
         db.session.commit()
+        cache.delete(_feed_cache_key())
 
         return redirect(f"/users/{g.user.id}")
 
@@ -366,18 +630,26 @@ def show_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    return render_template(
+        'messages/show.html',
+        message=msg,
+        liked_ids=_liked_message_ids([msg])
+    )
 
 
 @app.post('/messages/<int:msg_id>/like')
 def like_message(msg_id):
-    """Toggle like/unlike message and redirect to origin page."""
+    """Toggle like/unlike message and redirect to origin page.
 
-    form = g.csrf_form
+    For htmx requests, respond with the re-rendered like button instead.
+    """
+
+    if not _csrf_ok() or not g.user:
+        # htmx would follow a redirect and swap the page into the button
+        if request.headers.get('HX-Request'):
+            raise Forbidden
 
-    if not form.validate_on_submit() or not g.user:
         flash("Access unauthorized.", "danger")
-        print(form.errors)
         return redirect("/")
 
     msg = Message.query.get_or_404(msg_id)
@@ -385,12 +657,28 @@ def like_message(msg_id):
     if msg.user_id == g.user.id:
         raise Forbidden
 
-    if msg in g.user.liked_messages:
-        g.user.liked_messages.remove(msg)
+    like = and_(Like.user_id == g.user.id, Like.message_id == msg_id)
+    liked = db.session.scalar(select(exists().where(like)))
+
+    if liked:
+        db.session.execute(delete(Like).where(like))
     else:
-        g.user.liked_messages.append(msg)
+        db.session.execute(
+            pg_insert(Like)
+            .values(user_id=g.user.id, message_id=msg_id)
+            .on_conflict_do_nothing()
+        )
 
     db.session.commit()
+    cache.delete(_feed_cache_key())
+
+    # htmx swaps in just the updated button instead of reloading the page
+    if request.headers.get('HX-Request'):
+        return render_template(
+            'messages/like-button.html',
+            message=msg,
+            liked_ids=frozenset() if liked else frozenset([msg.id])
+        )
 
     return redirect(request.referrer)
     # TODO: request.referrer May not be supported by all browsers,
@@ -405,13 +693,14 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if not g.user or not _csrf_ok():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
     db.session.delete(msg)
     db.session.commit()
+    cache.delete(_feed_cache_key())
 
     return redirect(f"/users/{g.user.id}")
 
@@ -421,24 +710,55 @@ def delete_message(message_id):
 
 
 @app.get('/')
+@cache.cached(
+    timeout=30,
+    key_prefix=_feed_cache_key,
+    unless=_skip_feed_cache,
+)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
     - logged in: 100 most recent messages of current user and the users
-      they follow
+      they follow (cached for 30 seconds, or until they post, like or
+      (un)follow)
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following]+[g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        feed_user_ids = union(
+            select(Follows.user_being_followed_id.label('user_id'))
+            .where(Follows.user_following_id == g.user.id),
+            select(literal(g.user.id).label('user_id')),
+        ).subquery()
+        # newest 100 of each author, read off ix_messages_user_id_timestamp,
+        # then the newest 100 of those
+        recent = (select(Message)
+                  .where(Message.user_id == feed_user_ids.c.user_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(100)
+                  .lateral())
+        recent_message = aliased(Message, recent)
+        feed = (select(recent_message)
+                .select_from(feed_user_ids)
+                .join(recent, true())
+                .order_by(recent_message.timestamp.desc())
+                .limit(100)
+                .options(
+                    selectinload(recent_message.author)
+                    .load_only(User.username, User.image_url),
+                    raiseload('*')
+                ))
+        messages = db.session.scalars(feed).all()
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            liked_ids=_liked_message_ids(messages),
+            counts=_user_counts(g.user.id)
+        )
 
-        return render_template('home.html', messages=messages)
+    elif _can_serve_prerendered():
+        return _serve_prerendered(_ANON_HOME_HTML)
 
     else:
         return render_template('home-anon.html')
@@ -446,15 +766,62 @@ def homepage():
 
 ##############################################################################
 # Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+#   (only registered in debug; in production the reverse proxy sets
+#   Cache-Control, see README "Deployment")
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
 def add_header(response):
     """Add non-caching headers on every request."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
     response.cache_control.no_store = True
     return response
+
+
+if app.debug:
+    app.after_request(add_header)
+
+
+##############################################################################
+# Pre-rendered pages for anonymous visitors
+#
+# The anon homepage and the empty login form only vary by CSRF token, so
+# render them once at startup and splice the token in per request.
+
+_CSRF_PLACEHOLDER = "__CSRF_TOKEN__"
+
+
+def _prerender(template, form_class=None):
+    """Render template as seen by an anonymous visitor, CSRF token removed.
+
+    If given, an empty `form_class` instance is passed in as `form`.
+    """
+
+    # fresh app context, so nothing from this render is left on the `g` of
+    # the app context connect_db keeps pushed
+    with app.app_context(), app.test_request_context():
+        token = generate_csrf()
+        form = form_class() if form_class else None
+        html = render_template(template, form=form)
+
+    return html.replace(token, _CSRF_PLACEHOLDER)
+
+
+def _can_serve_prerendered():
+    """Pre-rendered pages have no user nav and no flashed messages."""
+
+    return not g.user and '_flashes' not in session
+
+
+def _serve_prerendered(html):
+    """Respond with pre-rendered html, filled in with this session's token."""
+
+    return Response(
+        html.replace(_CSRF_PLACEHOLDER, generate_csrf()),
+        mimetype='text/html'
+    )
+
+
+_ANON_HOME_HTML = _prerender('home-anon.html')
+_LOGIN_HTML = _prerender('users/login.html', form_class=LoginForm)
@@ -1,11 +1,16 @@
 """SQLAlchemy models for Warbler."""
 
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.schema import CheckConstraint
-from sqlalchemy.orm import validates
+from sqlalchemy import event, DDL
+from sqlalchemy.schema import CheckConstraint, UniqueConstraint
+from sqlalchemy.orm import validates, configure_mappers
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -13,6 +18,41 @@ db = SQLAlchemy()
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+# bcrypt checks are deliberately slow and CPU-bound; run them in worker
+# processes so they don't tie up the request thread. Processes are only
+# started on first use.
+_BCRYPT_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+_BCRYPT_POOL_LOCK = threading.Lock()
+
+
+def _check_pw(stored_hash, password):
+    """Return whether `password` matches bcrypt `stored_hash`."""
+
+    return bcrypt.check_password_hash(stored_hash, password)
+
+
+def _check_pw_in_pool(stored_hash, password):
+    """Run _check_pw in the bcrypt pool.
+
+    If a pool worker has died (OOM, killed), the pool is unusable; replace
+    it and check this password inline. Threads that hit the same broken
+    pool replace it only once.
+    """
+
+    global _BCRYPT_POOL
+
+    pool = _BCRYPT_POOL
+
+    try:
+        return pool.submit(_check_pw, stored_hash, password).result()
+    except BrokenProcessPool:
+        with _BCRYPT_POOL_LOCK:
+            if _BCRYPT_POOL is pool:
+                _BCRYPT_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        return _check_pw(stored_hash, password)
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -21,13 +61,13 @@ class Follows(db.Model):
 
     user_being_followed_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete="cascade"),
+        db.ForeignKey('users.id', ondelete='CASCADE'),
         primary_key=True,
     )
 
     user_following_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete="cascade"),
+        db.ForeignKey('users.id', ondelete='CASCADE'),
         primary_key=True,
     )
 
@@ -82,7 +122,11 @@ class User(db.Model):
         nullable=False
     )
 
-    authored_messages = db.relationship('Message', backref="author")
+    authored_messages = db.relationship(
+        'Message',
+        backref="author",
+        passive_deletes=True
+    )
 
     followers = db.relationship(
         "User",
@@ -131,7 +175,7 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = _check_pw_in_pool(user.password, password)
             if is_auth:
                 return user
 
@@ -203,6 +247,10 @@ class Like(db.Model):
 
     __tablename__ = "likes"
 
+    __table_args__ = (
+        UniqueConstraint('user_id', 'message_id', name='likes_user_message'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -221,6 +269,35 @@ class Like(db.Model):
         nullable=False
     )
 
+
+# Feed queries filter on author and sort newest-first
+db.Index(
+    'ix_messages_user_id_timestamp',
+    Message.user_id,
+    Message.timestamp.desc(),
+)
+
+# User search does substring matching (ILIKE '%q%'), which a btree can't
+# serve; a trigram GIN index can
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+)
+
+db.Index(
+    'ix_users_username_trgm',
+    User.username,
+    postgresql_using='gin',
+    postgresql_ops={'username': 'gin_trgm_ops'},
+)
+
+
+# Set up backref attributes (User.following, User.liked_messages, ...) now,
+# so they can be used in loader options before the first query runs
+configure_mappers()
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
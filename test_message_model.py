@@ -131,4 +131,16 @@ class MessageModelTestCase(TestCase):
         with self.assertRaises(IntegrityError):
             like = Like(user_id=self.u2_id, message_id=1000)
             db.session.add(like)
-            db.session.commit()
\ No newline at end of file
+            db.session.commit()
+
+    def test_message_likes_duplicate(self):
+        """
+        Test that a user cannot like the same message twice
+        """
+
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.commit()
+
+        with self.assertRaises(IntegrityError):
+            db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+            db.session.commit()
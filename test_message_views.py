@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, Message, User
+from models import db, Message, User, Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +19,11 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from flask import g, session
+
+from app import (
+    app, limiter, CURR_USER_KEY, _feed_cache_key, _skip_feed_cache
+)
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -54,6 +58,7 @@ class MessageBaseViewTestCase(TestCase):
         self.m1_id = m1.id
 
         self.client = app.test_client()
+        limiter.reset()
 
 
 class MessageAddViewTestCase(MessageBaseViewTestCase):
@@ -71,3 +76,135 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
 
             Message.query.filter_by(text="Hello").one()
+
+
+class HomepageFeedViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        u2.followers.append(User.query.get(self.u1_id))
+        db.session.add_all([
+            Message(text="m2-followed-text", user_id=u2.id),
+            Message(text="m3-unfollowed-text", user_id=u3.id),
+        ])
+        db.session.commit()
+
+    def test_feed(self):
+        """Feed has own and followed users' messages, and nobody else's"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m1-text", html)
+            self.assertIn("m2-followed-text", html)
+            self.assertNotIn("m3-unfollowed-text", html)
+
+
+class MessageLikeViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.m2_id = m2.id
+
+    def test_like_htmx(self):
+        """htmx like toggles return just the re-rendered like button"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(
+                f"/messages/{self.m2_id}/like",
+                headers={"HX-Request": "true"}
+            )
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bi-heart-fill", html)
+            self.assertNotIn("<html", html)
+            Like.query.filter_by(
+                user_id=self.u1_id, message_id=self.m2_id
+            ).one()
+
+            resp = c.post(
+                f"/messages/{self.m2_id}/like",
+                headers={"HX-Request": "true"}
+            )
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("bi-heart-fill", html)
+            self.assertIsNone(Like.query.filter_by(
+                user_id=self.u1_id, message_id=self.m2_id
+            ).one_or_none())
+
+    def test_like_htmx_without_csrf_token(self):
+        """htmx like without a CSRF token is refused, not redirected"""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.post(
+                    f"/messages/{self.m2_id}/like",
+                    headers={"HX-Request": "true"}
+                )
+
+                self.assertEqual(resp.status_code, 403)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FeedCacheKeyTestCase(MessageBaseViewTestCase):
+    def feed_cache_key(self, csrf_token):
+        """Feed cache key for u1 in a session holding `csrf_token`"""
+
+        with app.app_context(), app.test_request_context():
+            g.user = User.query.get(self.u1_id)
+            session["csrf_token"] = csrf_token
+            return _feed_cache_key()
+
+    def test_feed_cache_key(self):
+        """Key is per user and per session, and doesn't leak the token"""
+
+        key = self.feed_cache_key("session-a-token")
+
+        self.assertTrue(key.startswith(f"feed:{self.u1_id}:"))
+        self.assertNotIn("session-a-token", key)
+        self.assertEqual(key, self.feed_cache_key("session-a-token"))
+        self.assertNotEqual(key, self.feed_cache_key("session-b-token"))
+
+    def test_skip_feed_cache(self):
+        """Feed isn't cached for anon users, with flashes, or without token"""
+
+        with app.app_context(), app.test_request_context():
+            g.user = None
+            self.assertTrue(_skip_feed_cache())
+
+            g.user = User.query.get(self.u1_id)
+            self.assertTrue(_skip_feed_cache())
+
+            session["csrf_token"] = "session-a-token"
+            self.assertFalse(_skip_feed_cache())
+
+            session["_flashes"] = [("success", "Hello")]
+            self.assertTrue(_skip_feed_cache())
@@ -1,10 +1,12 @@
 """User model tests."""
 
 import os
+from concurrent.futures.process import BrokenProcessPool
 from sqlalchemy.exc import IntegrityError
 from unittest import TestCase
 from flask_bcrypt import Bcrypt
 
+import models
 from models import db, User
 
 # Environmental variable for URL
@@ -200,4 +202,27 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(
             User.authenticate(username="u1", password="badpassword")
-        )
\ No newline at end of file
+        )
+
+    def test_user_authenticate_after_pool_worker_dies(self):
+        """Test authenticate recovers when a bcrypt pool worker has died"""
+
+        broken_pool = models._BCRYPT_POOL
+
+        with self.assertRaises(BrokenProcessPool):
+            broken_pool.submit(os._exit, 1).result()
+
+        u1_db = User.query.get(self.u1_id)
+
+        self.assertEqual(
+            User.authenticate(username="u1", password="password"),
+            u1_db
+        )
+        new_pool = models._BCRYPT_POOL
+        self.assertIsNot(new_pool, broken_pool)
+
+        self.assertEqual(
+            User.authenticate(username="u1", password="password"),
+            u1_db
+        )
+        self.assertIs(models._BCRYPT_POOL, new_pool)
@@ -1,15 +1,20 @@
 """User view function tests."""
 
 import os
+import re
+from contextlib import contextmanager
 from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Like
+from models import db, User, Message, Like, Follows
 from app import CURR_USER_KEY
 
 # Environmental variable for URL
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-from app import app
+import app as app_module
+from app import app, limiter, csrf_form
 
 # Don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -25,6 +30,29 @@ db.drop_all()
 db.create_all()
 
 
+def get_csrf_token(html):
+    """Return the CSRF token from the first hidden csrf_token input."""
+
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                     html).group(1)
+
+
+@contextmanager
+def capture_statements():
+    """Collect the SQL statements run on the engine inside the block."""
+
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, "before_cursor_execute", count_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_statement)
+
+
 class UserRoutesTestCase(TestCase):
     def setUp(self):
         """Create demo data"""
@@ -39,6 +67,7 @@ class UserRoutesTestCase(TestCase):
         self.u2_id = u2.id
 
         self.client = app.test_client()
+        limiter.reset()
 
     def tearDown(self):
         """Clean up fouled transactions"""
@@ -77,6 +106,88 @@ class UserRoutesTestCase(TestCase):
 
     # form does not validate
 
+    def test_login_get_not_rate_limited(self):
+        """Test viewing the login form doesn't use up the login limit"""
+
+        with app.test_client() as client:
+            for _ in range(6):
+                resp = client.get("/login")
+                self.assertEqual(resp.status_code, 200)
+
+    def test_login_post_rate_limited(self):
+        """Test more than 5 login attempts a minute are refused"""
+
+        with app.test_client() as client:
+            for _ in range(5):
+                resp = client.post("/login", data={
+                    "username": "u1",
+                    "password": "wrong-password",
+                })
+                self.assertEqual(resp.status_code, 200)
+
+            resp = client.post("/login", data={
+                "username": "u1",
+                "password": "password",
+            })
+            self.assertEqual(resp.status_code, 429)
+
+    def test_login_rate_limit_per_forwarded_client(self):
+        """Test clients behind the proxy get separate login limits"""
+
+        with app.test_client() as client:
+            for _ in range(5):
+                client.post(
+                    "/login",
+                    data={"username": "u1", "password": "wrong-password"},
+                    headers={"X-Forwarded-For": "203.0.113.1"}
+                )
+
+            resp = client.post(
+                "/login",
+                data={"username": "u1", "password": "wrong-password"},
+                headers={"X-Forwarded-For": "203.0.113.1"}
+            )
+            self.assertEqual(resp.status_code, 429)
+
+            resp = client.post(
+                "/login",
+                data={"username": "u1", "password": "wrong-password"},
+                headers={"X-Forwarded-For": "203.0.113.2"}
+            )
+            self.assertEqual(resp.status_code, 200)
+
+    def test_demo_caches_guest_id(self):
+        """Test demo login authenticates once, then reuses the guest id"""
+
+        guest = User.signup("guest", "guest@email.com", "password", None)
+        db.session.commit()
+        app_module._GUEST_ID = None
+
+        with app.test_client() as client:
+            resp = client.post("/demo")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(app_module._GUEST_ID, guest.id)
+
+            with patch.object(User, "authenticate") as authenticate:
+                resp = client.post("/demo")
+                authenticate.assert_not_called()
+
+            self.assertEqual(resp.location, "/")
+            with client.session_transaction() as sess:
+                self.assertEqual(sess[CURR_USER_KEY], guest.id)
+
+    def test_demo_stale_guest_id(self):
+        """Test demo login re-authenticates if cached guest is gone"""
+
+        guest = User.signup("guest", "guest@email.com", "password", None)
+        db.session.commit()
+        app_module._GUEST_ID = -1
+
+        with app.test_client() as client:
+            resp = client.post("/demo")
+            self.assertEqual(resp.location, "/")
+            self.assertEqual(app_module._GUEST_ID, guest.id)
+
     ########################################################################
     # Logout route tests
 
@@ -101,6 +212,34 @@ class UserRoutesTestCase(TestCase):
             self.assertIn("u2", html)
 
 
+    def test_list_users_pages(self):
+        """Test /users lists 50 users a page, continuing after 'after'"""
+
+        db.session.add_all([
+            User(username=f"user{i:02}", email=f"user{i:02}@email.com",
+                 password="password")
+            for i in range(55)
+        ])
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = client.get("/users").get_data(as_text=True)
+            self.assertIn("@u1<", html)
+            self.assertIn("@user47<", html)
+            self.assertNotIn("@user48<", html)
+
+            next_after = re.search(r'/users\?after=(\d+)', html).group(1)
+            resp = client.get(f"/users?after={next_after}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@user48<", html)
+            self.assertIn("@user54<", html)
+            self.assertNotIn("@u1<", html)
+            self.assertNotIn("/users?after=", html)
+
     def test_show_user(self):
         """Test page showing user profile"""
 
@@ -173,3 +312,188 @@ class UserRoutesTestCase(TestCase):
             u2 = User.query.get(self.u2_id)
             self.assertEqual(u2.followers, [u1])
 
+    def test_show_own_following_query_count(self):
+        """Test own following page doesn't query once per followed user"""
+
+        u1 = User.query.get(self.u1_id)
+        for i in range(10):
+            u1.following.append(
+                User.signup(f"f{i}", f"f{i}@email.com", "password", None)
+            )
+        db.session.commit()
+        # start the request with nothing in the identity map
+        db.session.expunge_all()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with capture_statements() as statements:
+                resp = client.get(f"/users/{self.u1_id}/following")
+
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@f9", html)
+            self.assertLess(len(statements), 10)
+
+    def test_show_user_bounded_message_queries(self):
+        """Test profile stats don't load the user's message collections"""
+
+        db.session.add_all(
+            [Message(text=f"msg{i}", user_id=self.u1_id) for i in range(3)]
+        )
+        db.session.commit()
+        db.session.expunge_all()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with capture_statements() as statements:
+                resp = client.get(f"/users/{self.u1_id}")
+
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("msg2", html)
+
+        unbounded = [
+            statement for statement in statements
+            if "FROM messages" in statement
+            and "LIMIT" not in statement
+            and "count(*)" not in statement
+        ]
+        self.assertEqual(unbounded, [])
+
+    def test_show_liked_messages_in_like_order(self):
+        """Test liked messages are listed most recently liked first"""
+
+        older = Message(text="older message", user_id=self.u2_id)
+        newer = Message(text="newer message", user_id=self.u2_id)
+        db.session.add_all([older, newer])
+        db.session.commit()
+
+        db.session.add(Like(user_id=self.u1_id, message_id=newer.id))
+        db.session.commit()
+        db.session.add(Like(user_id=self.u1_id, message_id=older.id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = client.get(f"/users/{self.u1_id}/liked-messages")
+
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index("older message"),
+                            html.index("newer message"))
+
+
+class CSRFRoutesTestCase(TestCase):
+    """Route tests with CSRF protection turned on, as in production."""
+
+    def setUp(self):
+        """Create demo data, turn on CSRF, reset rate limits"""
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        limiter.reset()
+
+    def tearDown(self):
+        """Clean up fouled transactions, turn CSRF back off"""
+
+        db.session.rollback()
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_login_with_prerendered_token(self):
+        """Test token spliced into pre-rendered login page is accepted"""
+
+        with app.test_client() as client:
+            resp = client.get("/login")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Welcome back.", html)
+            self.assertNotIn("__CSRF_TOKEN__", html)
+
+            with client.session_transaction() as sess:
+                self.assertIn("csrf_token", sess)
+
+            resp = client.post("/login", data={
+                "csrf_token": get_csrf_token(html),
+                "username": "u1",
+                "password": "password",
+            })
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+
+            with client.session_transaction() as sess:
+                self.assertEqual(sess[CURR_USER_KEY], self.u1_id)
+
+    def test_prerendered_token_per_session(self):
+        """Test each session gets its own token on the anon homepage"""
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("<!-- Test: home-anon page -->", html)
+            first_token = get_csrf_token(html)
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+            self.assertNotEqual(get_csrf_token(html), first_token)
+
+            with client.session_transaction() as sess:
+                self.assertIn("csrf_token", sess)
+
+    def test_csrf_form_per_request(self):
+        """Test csrf_form is built once per request, not shared between"""
+
+        with app.test_request_context():
+            first_form = csrf_form._get_current_object()
+            self.assertIs(csrf_form._get_current_object(), first_form)
+
+        with app.test_request_context():
+            self.assertIsNot(csrf_form._get_current_object(), first_form)
+
+    def test_follow_with_page_token(self):
+        """Test a POST with the token from the rendered page is accepted"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            html = client.get(f"/users/{self.u2_id}").get_data(as_text=True)
+
+            resp = client.post(
+                f"/users/follow/{self.u2_id}",
+                data={"csrf_token": get_csrf_token(html)}
+            )
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNotNone(db.session.get(
+                Follows, (self.u2_id, self.u1_id)
+            ))
+
+    def test_missing_token_rejected_after_valid_post(self):
+        """Test a valid POST doesn't let the next token-less POST through"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            html = client.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            client.post(
+                f"/users/follow/{self.u2_id}",
+                data={"csrf_token": get_csrf_token(html)}
+            )
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            resp = client.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+            self.assertIsNotNone(db.session.get(User, self.u2_id))